@@ -8,15 +8,33 @@ and forwards simplified play/pause/media_end events to a Home Assistant webhook.
 Config: reads .env from the same directory (or use real env vars).
 """
 
+import heapq
+import http.client
+import itertools
 import json
 import logging
+import math
 import os
+import queue
+import signal
 import threading
+import time
 import urllib.request
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import urlsplit
+
+try:
+    import orjson  # optional: faster JSON, falls back to stdlib json
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
 
 # ── Load .env ───────────────────────────────────────────────────────────────
 
@@ -41,6 +59,9 @@ HA_WEBHOOK_URL: str = os.environ.get("HA_WEBHOOK_URL", "")
 PORT: int = int(os.environ.get("PORT", "8099"))
 PAUSE_DEBOUNCE_SECS: float = float(os.environ.get("PAUSE_DEBOUNCE_SECS", "5"))
 CREDITS_THRESHOLD_PCT: float = float(os.environ.get("CREDITS_THRESHOLD_PCT", "95"))
+MAX_SESSIONS: int = max(1, int(os.environ.get("MAX_SESSIONS", "256")))
+BATCH_FLUSH_MS: int = int(os.environ.get("BATCH_FLUSH_MS", "0"))   # 0 = one POST per event
+BATCH_SIZE: int = max(1, int(os.environ.get("BATCH_SIZE", "20")))
 ALLOWED_DEVICES_RAW: str = os.environ.get("ALLOWED_DEVICES", "")
 ALLOWED_DEVICES: set[str] = (
     {d.strip().lower() for d in ALLOWED_DEVICES_RAW.split(",") if d.strip()}
@@ -58,10 +79,16 @@ logging.basicConfig(
     datefmt="%H:%M:%S",
 )
 log = logging.getLogger("jellyfin-ha")
+_DEBUG: bool = log.isEnabledFor(logging.DEBUG)   # guards per-event debug logging
 
 # ── Session state (per device) ────────────────────────────────────────────────
 
-@dataclass
+# Pause generations are unique process-wide, so a Session recreated after
+# eviction can never match a stale entry still sitting in the scheduler heap.
+_pause_gens = itertools.count(1)
+
+
+@dataclass(slots=True)
 class Session:
     device_id: str
     device_name: str = ""
@@ -75,18 +102,57 @@ class Session:
     last_position_ticks: int = 0
     media_end_emitted: bool = False
     credits_start_ticks: int | None = None  # from chapter data
-    _pause_timer: threading.Timer | None = field(default=None, repr=False)
+    _credits_ticks: int = field(default=0, repr=False)  # CREDITS_THRESHOLD_PCT of run_time_ticks
+    _pause_gen: int = field(default_factory=lambda: next(_pause_gens), repr=False)
+    _last_seen: float = field(default=0.0, repr=False)  # monotonic time of last event
     _debouncing: bool = False            # True while waiting for debounce
 
     def cancel_pause_timer(self) -> None:
-        if self._pause_timer is not None:
-            self._pause_timer.cancel()
-            self._pause_timer = None
+        # Any entry already in the scheduler heap is now stale and ignored when it fires
+        self._pause_gen = next(_pause_gens)
         self._debouncing = False
 
 
-sessions: dict[str, Session] = {}
-_lock = threading.Lock()
+# Sessions are striped across _SHARDS dicts, each guarded by its own lock,
+# so events for different devices don't contend on a single lock.
+_SHARDS = 16   # power of two
+_locks = [threading.Lock() for _ in range(_SHARDS)]
+_shards: list[dict[str, Session]] = [{} for _ in range(_SHARDS)]
+
+
+def _bucket(device_id: str) -> tuple[threading.Lock, dict[str, Session]]:
+    h = hash(device_id) & (_SHARDS - 1)
+    return _locks[h], _shards[h]
+
+
+def _session_count() -> int:
+    return sum(len(sessions) for sessions in _shards)
+
+
+def _evict_lru(keep: str) -> None:
+    """Forget one session to get back under MAX_SESSIONS: the least recently
+    seen one, preferring idle devices and never one that is mid-debounce.
+    Takes one shard lock at a time, so it must be called with none held."""
+    victim, best = None, None
+    for lock, sessions in zip(_locks, _shards):
+        with lock:
+            for did, s in sessions.items():
+                if did == keep or s._debouncing:
+                    continue
+                rank = (s.state != "idle", s._last_seen)
+                if best is None or rank < best:
+                    victim, best = did, rank
+    if victim is None:
+        return
+
+    lock, sessions = _bucket(victim)
+    with lock:
+        s = sessions.get(victim)
+        if s is None or s._debouncing:
+            return
+        del sessions[victim]
+        s.cancel_pause_timer()
+    log.info("EVICT     device=%-15s  (least recently seen)", s.device_name or victim)
 
 # ── Resolve Jellyfin user ID from username ────────────────────────────────────
 
@@ -103,7 +169,7 @@ def _resolve_jellyfin_user_id() -> str:
     )
     try:
         with urllib.request.urlopen(req, timeout=5) as resp:
-            users = json.loads(resp.read())
+            users = _json_loads(resp.read())
     except Exception as e:
         log.error("Could not fetch Jellyfin users: %s", e)
         return ""
@@ -138,7 +204,7 @@ def _fetch_credits_ticks(item_id: str) -> int | None:
     )
     try:
         with urllib.request.urlopen(req, timeout=5) as resp:
-            data = json.loads(resp.read())
+            data = _json_loads(resp.read())
     except Exception as e:
         log.warning("Could not fetch chapters for %s: %s", item_id, e)
         return None
@@ -159,23 +225,183 @@ def _fetch_credits_ticks(item_id: str) -> int | None:
 
 # ── Notify Home Assistant ─────────────────────────────────────────────────────
 
+_HA_URL = urlsplit(HA_WEBHOOK_URL)
+_HA_PATH = (_HA_URL.path or "/") + (f"?{_HA_URL.query}" if _HA_URL.query else "")
+_HA_CONN_CLS = (
+    http.client.HTTPSConnection if _HA_URL.scheme == "https" else http.client.HTTPConnection
+)
+_HA_POOL_MAX = 1   # only the dispatcher thread POSTs, one request at a time
+_ha_idle: list[http.client.HTTPConnection] = []   # keep-alive connections to HA
+_ha_idle_lock = threading.Lock()
+
+
+class _NoReply(Exception):
+    """The request was sent but HA didn't answer in time; it may have been
+    processed, so re-sending could trigger the automation twice."""
+
+
+def _post_on(conn: http.client.HTTPConnection, data: bytes) -> int:
+    conn.request("POST", _HA_PATH, body=data, headers={"Content-Type": "application/json"})
+    try:
+        resp = conn.getresponse()
+    except TimeoutError as e:
+        raise _NoReply(e) from e
+    resp.read()
+    return resp.status
+
+
+def _post_ha(data: bytes) -> int:
+    """POST to HA reusing an idle keep-alive connection when one is available.
+    A reused connection that HA closed while idle is replaced once; any other
+    failure (notably a read timeout, when HA may already have the request)
+    is raised rather than re-sent."""
+    with _ha_idle_lock:
+        conn = _ha_idle.pop() if _ha_idle else None
+
+    status = None
+    if conn is not None:
+        try:
+            status = _post_on(conn, data)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()   # stale keep-alive — retry on a fresh connection
+            conn = None
+        except Exception:
+            conn.close()
+            raise
+    if conn is None:
+        conn = _HA_CONN_CLS(_HA_URL.netloc, timeout=5)
+        try:
+            status = _post_on(conn, data)
+        except Exception:
+            conn.close()
+            raise
+
+    with _ha_idle_lock:
+        if len(_ha_idle) < _HA_POOL_MAX:
+            _ha_idle.append(conn)
+            conn = None
+    if conn is not None:
+        conn.close()
+    return status
+
+
+def _deliver(data: bytes, what: str) -> bool:
+    """POST once. Returns False if the failure is worth retrying
+    (connection error or 5xx), True otherwise."""
+    try:
+        status = _post_ha(data)
+    except _NoReply as e:
+        log.error("→ HA no reply to %s (%s) — not retried, it may have arrived", what, e.__cause__)
+        return True
+    except Exception as e:
+        log.error("→ HA failed: %s", e)
+        return False
+    if status >= 500:
+        log.error("→ HA failed: HTTP %s", status)
+        return False
+    if status >= 400:
+        log.error("→ HA rejected %s: HTTP %s", what, status)
+    else:
+        log.info("→ HA %s  (status %s)", what, status)
+    return True
+
+
+# Outbound POSTs go through a bounded queue drained by a single dispatcher
+# thread, so request handling never waits on HA and events reach HA in the
+# order they were emitted. Failed POSTs are retried in place with exponential
+# backoff (holding back later events); while HA is down the queue fills and
+# the oldest entries are dropped.
+_OUT_QUEUE_MAX = 1024
+_NOTIFY_MAX_ATTEMPTS = 5
+_out_q: queue.Queue[tuple[bytes, str]] = queue.Queue(maxsize=_OUT_QUEUE_MAX)
+
+
+def _enqueue(data: bytes, what: str) -> None:
+    while True:
+        try:
+            _out_q.put_nowait((data, what))
+            return
+        except queue.Full:
+            try:
+                _, dropped = _out_q.get_nowait()
+            except queue.Empty:
+                continue
+            _out_q.task_done()
+            log.warning("→ HA queue full — dropped oldest (%s)", dropped)
+
+
+def _dispatch_loop() -> None:
+    while True:
+        data, what = _out_q.get()
+        try:
+            for attempt in range(_NOTIFY_MAX_ATTEMPTS):
+                if attempt:
+                    time.sleep(min(30, 2 ** attempt))
+                if _deliver(data, what):
+                    break
+            else:
+                log.error("→ HA giving up on %s after %s attempts", what, _NOTIFY_MAX_ATTEMPTS)
+        finally:
+            _out_q.task_done()
+
+
+threading.Thread(target=_dispatch_loop, name="ha-notify", daemon=True).start()
+
+
 def _notify_ha(payload: dict) -> None:
     if not HA_WEBHOOK_URL:
         log.warning("HA_WEBHOOK_URL not set — event dropped: %s", payload)
         return
+    _enqueue(_json_dumps(payload), payload["event"])
 
-    data = json.dumps(payload).encode()
-    req = urllib.request.Request(
-        HA_WEBHOOK_URL,
-        data=data,
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
-    try:
-        with urllib.request.urlopen(req, timeout=5) as resp:
-            log.info("→ HA %s  (status %s)", payload["event"], resp.status)
-    except Exception as e:
-        log.error("→ HA failed: %s", e)
+
+def _notify_ha_batch(events: list[dict]) -> None:
+    if not HA_WEBHOOK_URL:
+        log.warning("HA_WEBHOOK_URL not set — %d events dropped", len(events))
+        return
+    _enqueue(_json_dumps({"events": events}), f"batch of {len(events)}")
+
+
+# Batch mode (BATCH_FLUSH_MS > 0): payloads are collected and POSTed as
+# {"events": [...]} once BATCH_SIZE is reached or BATCH_FLUSH_MS after the
+# first pending event, whichever comes first.
+_pending: list[dict] = []
+_pending_cv = threading.Condition()
+
+
+def _batch_loop() -> None:
+    while True:
+        with _pending_cv:
+            while not _pending:
+                _pending_cv.wait()
+            deadline = time.monotonic() + BATCH_FLUSH_MS / 1000
+            while len(_pending) < BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                _pending_cv.wait(remaining)
+            batch = _pending[:BATCH_SIZE]
+            del _pending[:BATCH_SIZE]
+        _notify_ha_batch(batch)
+
+
+if BATCH_FLUSH_MS > 0:
+    threading.Thread(target=_batch_loop, name="ha-batch", daemon=True).start()
+
+
+# (epoch second, ISO string) — emit() only needs second resolution, so format
+# once per second. Kept as one tuple so concurrent emitters never see a torn pair.
+_ts_cache: tuple[int, str] = (0, "")
+
+
+def _timestamp() -> str:
+    global _ts_cache
+    now = int(time.time())
+    sec, text = _ts_cache
+    if now != sec:
+        text = datetime.fromtimestamp(now, timezone.utc).isoformat(timespec="seconds")
+        _ts_cache = (now, text)
+    return text
 
 
 def emit(event: str, session: Session) -> None:
@@ -191,46 +417,234 @@ def emit(event: str, session: Session) -> None:
         "media": session.media_name,
         "media_type": session.media_type,
         "position_pct": position_pct,
-        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "timestamp": _timestamp(),
     }
     log.info(
         "EMIT %-10s  device=%-15s  media=%s  pos=%.1f%%",
         event, session.device_name, session.media_name, position_pct,
     )
-    threading.Thread(target=_notify_ha, args=(payload,), daemon=True).start()
+    if BATCH_FLUSH_MS > 0:
+        with _pending_cv:
+            _pending.append(payload)
+            _pending_cv.notify()
+    else:
+        _notify_ha(payload)
+
+# ── Pause debounce scheduler ──────────────────────────────────────────────────
+# A single thread fires all pending pause confirmations from a heap of
+# (deadline, device_id, generation) entries. Cancelling only bumps the
+# session's generation; stale entries are dropped when popped.
+
+_timer_heap: list[tuple[float, str, int]] = []
+_timer_cv = threading.Condition()
+
+
+def schedule(delay: float, device_id: str, gen: int) -> None:
+    with _timer_cv:
+        heapq.heappush(_timer_heap, (time.monotonic() + delay, device_id, gen))
+        _timer_cv.notify()
+
+
+def _confirm_pause(device_id: str, gen: int) -> None:
+    lock, sessions = _bucket(device_id)
+    with lock:
+        s = sessions.get(device_id)
+        if s and s._debouncing and s._pause_gen == gen:
+            s._debouncing = False
+            s.state = "paused"
+            emit("pause", s)
+
+
+def _scheduler_loop() -> None:
+    while True:
+        with _timer_cv:
+            while True:
+                timeout = None
+                if _timer_heap:
+                    timeout = _timer_heap[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        break
+                _timer_cv.wait(timeout)
+            _, device_id, gen = heapq.heappop(_timer_heap)
+        try:
+            _confirm_pause(device_id, gen)
+        except Exception:
+            log.exception("Pause confirmation failed for %s", device_id)
+
+
+threading.Thread(target=_scheduler_loop, name="pause-scheduler", daemon=True).start()
 
 # ── Core logic ────────────────────────────────────────────────────────────────
+# Event handlers run under the device's shard lock (held by process_event).
 
-def process_event(body: dict) -> None:
-    notification_type = body.get("NotificationType", "")
-    device_id = body.get("DeviceId", "")
-    device_name = body.get("DeviceName", "")
+def _load_chapters(item_id: str, device_id: str) -> None:
+    """Background: fetch chapter-based credits position for the session."""
+    ticks = _fetch_credits_ticks(item_id)
+    lock, sessions = _bucket(device_id)
+    with lock:
+        s = sessions.get(device_id)
+        if s and s.item_id == item_id:
+            s.credits_start_ticks = ticks
+            if ticks is not None:
+                log.info(
+                    "CREDITS   device=%-15s  using chapter at tick %s",
+                    s.device_name, ticks,
+                )
+            else:
+                log.info(
+                    "CREDITS   device=%-15s  no chapter found, using %s%% fallback",
+                    s.device_name, CREDITS_THRESHOLD_PCT,
+                )
+
+
+def _handle_start(s: Session, position_ticks: int, is_paused: bool) -> None:
+    # Just forward the raw Jellyfin event
+    s.cancel_pause_timer()
+    s.last_position_ticks = position_ticks
+    s.state = "playing"
+    s.media_end_emitted = False
+    # Fetch chapter-based credits position in background
+    if s.item_id:
+        threading.Thread(
+            target=_load_chapters, args=(s.item_id, s.device_id), daemon=True,
+        ).start()
+    emit("PlaybackStart", s)
+
+
+def _handle_stop(s: Session, position_ticks: int, is_paused: bool) -> None:
+    # Just forward the raw Jellyfin event
+    s.cancel_pause_timer()
+    s.last_position_ticks = position_ticks
+    s.state = "idle"
+    emit("PlaybackStop", s)
+
+
+def _credits_threshold(s: Session) -> int | None:
+    """Tick position where credits start, or None if it can't be known yet."""
+    if s.credits_start_ticks is not None:
+        # Chapter-based detection (precise)
+        return s.credits_start_ticks
+    if s.run_time_ticks > 0:
+        # Percentage-based fallback (threshold precomputed in ticks)
+        return s._credits_ticks
+    return None
+
+
+def _handle_progress(s: Session, position_ticks: int, is_paused: bool) -> None:
+    prev_position = s.last_position_ticks
+    s.last_position_ticks = position_ticks
+
+    # -- Determine credits threshold --
+    threshold = _credits_threshold(s)
+    in_credits = threshold is not None and position_ticks >= threshold
+    was_before_credits = threshold is not None and prev_position < threshold
+
+    # -- Reset media_end if user seeks backward below threshold --
+    if s.media_end_emitted and not in_credits:
+        s.media_end_emitted = False
+        log.debug("  media_end reset — user seeked back below credits threshold")
+
+    # -- Check media_end (credits) --
+    if not s.media_end_emitted and in_credits:
+        s.cancel_pause_timer()
+        s.media_end_emitted = True
+        s.state = "idle"
+        emit("media_end", s)
+        return
 
-    if not device_id:
+    # -- IsPaused=false → playing --
+    if not is_paused:
+        if s._debouncing:
+            # Seek detected: cancel pending pause, stay in "playing"
+            log.debug("  seek detected — cancelling pause debounce")
+            s.cancel_pause_timer()
+            # Don't emit play — we never really paused
+            return
+
+        if s.state in ("paused", "idle"):
+            # Don't emit play if we already emitted media_end
+            # (user is still in credits or past the threshold)
+            if s.media_end_emitted:
+                log.debug("  skip play — media already ended (in credits)")
+                return
+            s.state = "playing"
+            emit("play", s)
         return
 
-    # Filter by device name if configured
-    if ALLOWED_DEVICES and device_name.strip().lower() not in ALLOWED_DEVICES:
-        log.debug("SKIP device=%s (not in ALLOWED_DEVICES)", device_name)
+    # -- IsPaused=true → maybe pause --
+    if s.state == "playing" and not s._debouncing:
+        # Start debounce
+        s._debouncing = True
+
+        schedule(PAUSE_DEBOUNCE_SECS, s.device_id, s._pause_gen)
+        log.debug("  pause debounce started (%ss)", PAUSE_DEBOUNCE_SECS)
+
+
+_HANDLERS = {
+    "PlaybackStart": _handle_start,
+    "PlaybackStop": _handle_stop,
+    "PlaybackProgress": _handle_progress,
+}
+
+
+def _process_device_event(get, device_name: str) -> None:
+    """Shared body of process_event; get is the webhook body's .get and
+    device_name has already been read by the caller."""
+    notification_type = get("NotificationType", "")
+    device_id = get("DeviceId", "")
+
+    if not device_id:
         return
 
-    is_paused: bool = body.get("IsPaused", False)
-    position_ticks: int = body.get("PlaybackPositionTicks", 0)
-    run_time_ticks: int = body.get("RunTimeTicks", 0)
-    item_id: str = body.get("ItemId", "")
+    client_name: str = get("ClientName", "")
+    media_name: str = get("Name", "")
+    media_type: str = get("ItemType", "")
+    is_paused: bool = get("IsPaused", False)
+    position_ticks: int = get("PlaybackPositionTicks", 0)
+    run_time_ticks: int = get("RunTimeTicks", 0)
+    item_id: str = get("ItemId", "")
+    handler = _HANDLERS.get(notification_type)
+    lock, sessions = _bucket(device_id)
+
+    # Fast path: a PlaybackProgress that repeats the session's current state
+    # (same item, same position, same play/pause, no debounce pending, and
+    # media_end already matching whether that position is in the credits) is
+    # a no-op, so skip the lock entirely; only its last-seen time is refreshed
+    # for the LRU. The unlocked reads are racy but benign: a concurrent
+    # update can only make this event take the locked path, or be skipped
+    # when the update itself already applied the same state.
+    if handler is _handle_progress:
+        s = sessions.get(device_id)
+        if (
+            s is not None
+            and not s._debouncing
+            and position_ticks == s.last_position_ticks
+            and (not item_id or item_id == s.item_id)
+            and s.state == ("paused" if is_paused else "playing")
+        ):
+            threshold = _credits_threshold(s)
+            in_credits = threshold is not None and position_ticks >= threshold
+            if in_credits == s.media_end_emitted:
+                s._last_seen = time.monotonic()
+                return
 
-    with _lock:
+    created = False
+    with lock:
         s = sessions.get(device_id)
         if s is None:
             s = Session(device_id=device_id)
             sessions[device_id] = s
+            created = True
+        s._last_seen = time.monotonic()
 
         # Update metadata
-        s.device_name = body.get("DeviceName", s.device_name)
-        s.client_name = body.get("ClientName", s.client_name)
-        s.media_name = body.get("Name", s.media_name)
-        s.media_type = body.get("ItemType", s.media_type)
-        s.run_time_ticks = run_time_ticks or s.run_time_ticks
+        s.device_name = device_name or s.device_name
+        s.client_name = client_name or s.client_name
+        s.media_name = media_name or s.media_name
+        s.media_type = media_type or s.media_type
+        if run_time_ticks and run_time_ticks != s.run_time_ticks:
+            s.run_time_ticks = run_time_ticks
+            s._credits_ticks = math.ceil(run_time_ticks * CREDITS_THRESHOLD_PCT / 100)
 
         # New media item → reset
         if item_id and item_id != s.item_id:
@@ -239,136 +653,83 @@ def process_event(body: dict) -> None:
             s.media_end_emitted = False
             s.credits_start_ticks = None
 
-        log.debug(
-            "IN   %-18s  device=%-15s  paused=%s  pos=%s  state=%s  debouncing=%s",
-            notification_type, s.device_name, is_paused, position_ticks,
-            s.state, s._debouncing,
-        )
+        if _DEBUG:
+            log.debug(
+                "IN   %-18s  device=%-15s  paused=%s  pos=%s  state=%s  debouncing=%s",
+                notification_type, s.device_name, is_paused, position_ticks,
+                s.state, s._debouncing,
+            )
 
-        # ── PlaybackStart ────────────────────────────────────────────────
-        # Just forward the raw Jellyfin event
-        if notification_type == "PlaybackStart":
-            s.cancel_pause_timer()
-            s.last_position_ticks = position_ticks
-            s.state = "playing"
-            s.media_end_emitted = False
-            # Fetch chapter-based credits position in background
-            if item_id:
-                def _load_chapters(iid=item_id, did=device_id):
-                    ticks = _fetch_credits_ticks(iid)
-                    with _lock:
-                        ss = sessions.get(did)
-                        if ss and ss.item_id == iid:
-                            ss.credits_start_ticks = ticks
-                            if ticks is not None:
-                                log.info(
-                                    "CREDITS   device=%-15s  using chapter at tick %s",
-                                    ss.device_name, ticks,
-                                )
-                            else:
-                                log.info(
-                                    "CREDITS   device=%-15s  no chapter found, using %s%% fallback",
-                                    ss.device_name, CREDITS_THRESHOLD_PCT,
-                                )
-                threading.Thread(target=_load_chapters, daemon=True).start()
-            emit("PlaybackStart", s)
-            return
+        if handler is not None:
+            handler(s, position_ticks, is_paused)
 
-        # ── PlaybackStop ─────────────────────────────────────────────────
-        # Just forward the raw Jellyfin event
-        if notification_type == "PlaybackStop":
-            s.cancel_pause_timer()
-            s.last_position_ticks = position_ticks
-            s.state = "idle"
-            emit("PlaybackStop", s)
-            return
+    if created and _session_count() > MAX_SESSIONS:
+        _evict_lru(device_id)
 
-        # ── PlaybackProgress ─────────────────────────────────────────────
-        if notification_type != "PlaybackProgress":
-            return
 
-        prev_position = s.last_position_ticks
-        s.last_position_ticks = position_ticks
-
-        # -- Determine credits threshold --
-        if s.credits_start_ticks is not None:
-            # Chapter-based detection (precise)
-            in_credits = position_ticks >= s.credits_start_ticks
-            was_before_credits = prev_position < s.credits_start_ticks
-        elif s.run_time_ticks > 0:
-            # Percentage-based fallback
-            pct = position_ticks / s.run_time_ticks * 100
-            in_credits = pct >= CREDITS_THRESHOLD_PCT
-            was_before_credits = (prev_position / s.run_time_ticks * 100) < CREDITS_THRESHOLD_PCT
-        else:
-            in_credits = False
-            was_before_credits = False
-
-        # -- Reset media_end if user seeks backward below threshold --
-        if s.media_end_emitted and not in_credits:
-            s.media_end_emitted = False
-            log.debug("  media_end reset — user seeked back below credits threshold")
+def _process_event_all(body: dict) -> None:
+    get = body.get
+    _process_device_event(get, get("DeviceName", ""))
 
-        # -- Check media_end (credits) --
-        if not s.media_end_emitted and in_credits:
-            s.cancel_pause_timer()
-            s.media_end_emitted = True
-            s.state = "idle"
-            emit("media_end", s)
-            return
 
-        # -- IsPaused=false → playing --
-        if not is_paused:
-            if s._debouncing:
-                # Seek detected: cancel pending pause, stay in "playing"
-                log.debug("  seek detected — cancelling pause debounce")
-                s.cancel_pause_timer()
-                # Don't emit play — we never really paused
-                return
+def _process_event_filtered(body: dict) -> None:
+    get = body.get
+    device_name = get("DeviceName", "")
+    if device_name.strip().lower() not in ALLOWED_DEVICES:
+        if _DEBUG:
+            log.debug("SKIP device=%s (not in ALLOWED_DEVICES)", device_name)
+        return
+    _process_device_event(get, device_name)
 
-            if s.state in ("paused", "idle"):
-                # Don't emit play if we already emitted media_end
-                # (user is still in credits or past the threshold)
-                if s.media_end_emitted:
-                    log.debug("  skip play — media already ended (in credits)")
-                    return
-                s.state = "playing"
-                emit("play", s)
-            return
 
-        # -- IsPaused=true → maybe pause --
-        if is_paused:
-            if s.state == "playing" and not s._debouncing:
-                # Start debounce
-                s._debouncing = True
-
-                # Capture the device_id for the timer callback
-                did = device_id
-
-                def _confirm_pause(did=did):
-                    with _lock:
-                        ss = sessions.get(did)
-                        if ss and ss._debouncing:
-                            ss._debouncing = False
-                            ss._pause_timer = None
-                            ss.state = "paused"
-                            emit("pause", ss)
-
-                t = threading.Timer(PAUSE_DEBOUNCE_SECS, _confirm_pause)
-                t.daemon = True
-                s._pause_timer = t
-                t.start()
-                log.debug("  pause debounce started (%ss)", PAUSE_DEBOUNCE_SECS)
+# ALLOWED_DEVICES is fixed at startup, so pick the variant once instead of
+# testing it on every event.
+process_event = _process_event_filtered if ALLOWED_DEVICES else _process_event_all
+
+# ── Graceful shutdown ─────────────────────────────────────────────────────────
+
+_SHUTDOWN_DRAIN_SECS = 5   # stay under Docker's default 10s stop timeout
+
+
+def _cancel_pending_pauses() -> None:
+    """Drop pause debounces still waiting to fire — they can't be confirmed."""
+    for lock, sessions in zip(_locks, _shards):
+        with lock:
+            for s in sessions.values():
+                if s._debouncing:
+                    s.cancel_pause_timer()
+
+
+def _flush_pending_batch() -> None:
+    with _pending_cv:
+        batch = _pending[:]
+        _pending.clear()
+    for i in range(0, len(batch), BATCH_SIZE):
+        _notify_ha_batch(batch[i:i + BATCH_SIZE])
+
+
+def _drain_notifications(timeout: float) -> bool:
+    """Wait up to timeout for queued HA POSTs to finish. Returns True if drained."""
+    t = threading.Thread(target=_out_q.join, daemon=True)
+    t.start()
+    t.join(timeout)
+    return not t.is_alive()
 
 # ── HTTP Server ───────────────────────────────────────────────────────────────
 
+# Jellyfin webhook bodies are a few KiB; anything far larger is refused unread
+MAX_BODY_BYTES = 64 * 1024
+
 class Handler(BaseHTTPRequestHandler):
+    # Socket timeout: a client that stalls mid-request releases its thread
+    timeout = 10
+
     def log_message(self, fmt, *args):
         # Silence default access logs; we do our own logging
         pass
 
     def _send(self, code: int, body: dict) -> None:
-        data = json.dumps(body).encode()
+        data = _json_dumps(body)
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
         self.send_header("Content-Length", str(len(data)))
@@ -386,11 +747,19 @@ class Handler(BaseHTTPRequestHandler):
             self._send(404, {"ok": False})
             return
 
-        length = int(self.headers.get("Content-Length", "0"))
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+        except ValueError:
+            self._send(400, {"ok": False, "error": "bad content-length"})
+            return
+        if length > MAX_BODY_BYTES:
+            log.warning("Rejected %s-byte body (max %s)", length, MAX_BODY_BYTES)
+            self._send(413, {"ok": False, "error": "body too large"})
+            return
         raw = self.rfile.read(length) if length > 0 else b""
 
         try:
-            body = json.loads(raw) if raw else {}
+            body = _json_loads(raw) if raw else {}
         except Exception:
             self._send(400, {"ok": False, "error": "bad json"})
             return
@@ -411,13 +780,37 @@ def main() -> None:
         log.info("  Jellyfin user:    %s (%s)", JELLYFIN_USERNAME, JELLYFIN_USER_ID)
     log.info("  Pause debounce:   %ss", PAUSE_DEBOUNCE_SECS)
     log.info("  Credits fallback: %s%%", CREDITS_THRESHOLD_PCT)
+    log.info("  Max sessions:     %s", MAX_SESSIONS)
+    if BATCH_FLUSH_MS > 0:
+        log.info("  Batching:         up to %s events every %sms", BATCH_SIZE, BATCH_FLUSH_MS)
     if ALLOWED_DEVICES:
         log.info("  Allowed devices:  %s", ", ".join(sorted(ALLOWED_DEVICES)))
     else:
         log.info("  Allowed devices:  (all)")
 
-    httpd = HTTPServer(("0.0.0.0", PORT), Handler)
+    httpd = ThreadingHTTPServer(("0.0.0.0", PORT), Handler)
+
+    def _graceful(signum, frame):
+        log.info("%s received — shutting down", signal.Signals(signum).name)
+        # shutdown() blocks until serve_forever() returns, and serve_forever()
+        # is running on this (main) thread, so call it from another thread.
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, _graceful)
+    signal.signal(signal.SIGINT, _graceful)
+
     httpd.serve_forever()
+    # Handler threads are daemons, so server_close() doesn't wait for them: a
+    # request still being handled here may emit after the flush/drain below,
+    # and that event is lost at exit.
+    httpd.server_close()
+
+    _cancel_pending_pauses()
+    _flush_pending_batch()
+    if not _drain_notifications(_SHUTDOWN_DRAIN_SECS):
+        # unfinished_tasks also counts the event the dispatcher is retrying
+        log.warning("→ HA %s event(s) still pending at exit", _out_q.unfinished_tasks)
+    log.info("Stopped")
 
 
 if __name__ == "__main__":